@@ -1,8 +1,7 @@
-from copy import copy
+import random
 import typing
 import numpy as np
 import tables
-import itertools
 
 import autopilot
 from autopilot.tasks.nafc import Nafc
@@ -10,9 +9,76 @@ from autopilot.networking import Net_Node
 from autopilot.utils.common import find_key_recursive
 from autopilot import prefs
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _as_1d(x: typing.Union[str, float, list]) -> np.ndarray:
+    """
+    Normalize a laser parameter -- a single value (usually a string from the
+    protocol wizard) or a list of values -- to a 1-d float64 array.
+    """
+    if isinstance(x, str):
+        x = float(x)
+    return np.atleast_1d(np.asarray(x, dtype=np.float64))
+
+
+def _build_series(duration: float, freq: float, duty_cycle: float) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Build the on/off pulse series for a single laser condition.
+
+    Compiled with :func:`numba.njit` when numba is importable -- for
+    multi-second trains at kHz rates the native fill is much faster than
+    the interpreted one, and ``cache=True`` keeps the compilation cost to
+    the first task start.
+
+    Args:
+        duration (float): total time the series covers (ms)
+        freq (float): pulse frequency (Hz)
+        duty_cycle (float): fraction (0-1) of each cycle the laser is on
+
+    Returns:
+        tuple of (durations, values) arrays -- durations in ms, values 0/1
+    """
+    # get the durations of on and off for a single cycle
+    cycle_duration = (1/freq)*1000 # convert Hz to ms
+    duty_cycle_on = duty_cycle * cycle_duration
+    duty_cycle_off = cycle_duration - duty_cycle_on
+
+    # fill the on/off cells for all complete cycles in one vectorized stroke
+    n_cycles = int(duration // cycle_duration)
+    durations = np.empty(2*n_cycles + 2, dtype=np.float64)
+    values = np.empty(2*n_cycles + 2, dtype=np.int8)
+    durations[0:2*n_cycles:2] = duty_cycle_on
+    durations[1:2*n_cycles:2] = duty_cycle_off
+    values[0:2*n_cycles:2] = 1
+    values[1:2*n_cycles:2] = 0
+
+    # pad any incomplete cycles, trimming the unused tail cell if the
+    # remainder fits in a single on-period
+    dur_remaining = duration - (cycle_duration * n_cycles)
+    if dur_remaining < duty_cycle_on:
+        durations[2*n_cycles] = dur_remaining
+        values[2*n_cycles] = 1
+        return durations[:2*n_cycles + 1], values[:2*n_cycles + 1]
+
+    durations[2*n_cycles] = duty_cycle_on
+    durations[2*n_cycles + 1] = dur_remaining - duty_cycle_on
+    values[2*n_cycles] = 1
+    values[2*n_cycles + 1] = 0
+    return durations, values
+
+
+if njit is not None:
+    _build_series = njit(cache=True)(_build_series)
+
+
 class Nafc_Gap(Nafc):
-    PARAMS = copy(Nafc.PARAMS)
-    del PARAMS['punish_stim']
+    # copy the per-param dicts too, so edits here can never alias the
+    # parent's schema
+    PARAMS = {k: dict(v) for k, v in Nafc.PARAMS.items() if k != 'punish_stim'}
     PARAMS['noise_amplitude'] = {'tag':'Amplitude of continuous white noise',
                                  'type': 'float'}
 
@@ -34,8 +100,17 @@ class Nafc_Gap(Nafc):
         self.logger.debug('starting background sound')
         self.noise_amplitude = noise_amplitude
         self.noise_duration = 10*1000 # 10 seconds
-        self.noise = autopilot.get('sound', 'Noise')(duration=self.noise_duration,
-                                  amplitude=self.noise_amplitude)
+        noise_class = autopilot.get('sound', 'Noise')
+        try:
+            # ask for an int16 sample table if the sound backend supports it --
+            # halves the memory bandwidth of streaming the continuous buffer
+            self.noise = noise_class(duration=self.noise_duration,
+                                     amplitude=self.noise_amplitude,
+                                     dtype='int16')
+        except TypeError:
+            # backend without a dtype knob, keep its native float table
+            self.noise = noise_class(duration=self.noise_duration,
+                                     amplitude=self.noise_amplitude)
 
         self.noise.play_continuous()
         self.logger.debug('background sound started')
@@ -57,7 +132,7 @@ class Nafc_Gap(Nafc):
 
 
 class Nafc_Gap_Laser(Nafc_Gap):
-    PARAMS = copy(Nafc_Gap.PARAMS)
+    PARAMS = {k: dict(v) for k, v in Nafc_Gap.PARAMS.items()}
     PARAMS['laser_probability'] = {'tag': 'Probability (of trials whose targets match laser_mode) of laser being turned on (0-1)',
                                    'type':'float'}
     PARAMS['laser_mode'] = {'tag':'Laser Mode, laser will be possible when target == ?',
@@ -77,7 +152,10 @@ class Nafc_Gap_Laser(Nafc_Gap):
                                 'type': 'list',
                                 'values':{'ON': 0, 'STIM': 1, 'LASER': 2}}
 
-    HARDWARE = copy(Nafc_Gap.HARDWARE)
+    # copy each hardware group dict as well -- a shallow copy aliases the
+    # parent's nested LEDS dict, so adding TOP below would also mutate
+    # Nafc_Gap.HARDWARE for every other subclass and introspection
+    HARDWARE = {group: dict(components) for group, components in Nafc_Gap.HARDWARE.items()}
 
     HARDWARE['LASERS'] = {
         'LR': 'Digital_Out'
@@ -129,29 +207,55 @@ class Nafc_Gap_Laser(Nafc_Gap):
                 'duty_cycle': laser duty cycle,
                 'duration': laser duration,
                 'script_id': script ID for the series used by the laser Digital Out object,
+                'trigger': pre-bound callable that plays the series on the laser Digital Out object,
                 }
         """
         self.laser_probability = float(laser_probability)
         self.laser_mode = str(laser_mode).upper()
         self.arena_led_mode = arena_led_mode
-
-        # accept them if we're given a list of values, otherwise they should be strings that are single values,
-        # which are put in lists so they can be iterated over in the product iterator.
-        self.laser_freq = laser_freq if isinstance(laser_freq, list) else [float(laser_freq)] # type: list
-        self.laser_duty_cycle = laser_duty_cycle if isinstance(laser_duty_cycle, list) else [float(laser_duty_cycle)] # type: list
-        self.laser_durations = laser_durations if isinstance(laser_durations, list) else [float(laser_durations)] # type: list
-
-        self.laser_conditions = tuple() # type: typing.Tuple[typing.Dict]
+        # the mode never changes after init, so fold the per-trial string
+        # comparisons in request/stim_end into booleans now
+        self._led_stim = self.arena_led_mode == "STIM"
+        self._led_laser = self.arena_led_mode == "LASER"
+
+        # accept either a list of values or a string that is a single value --
+        # normalized to 1-d arrays that feed the condition grid directly
+        self.laser_freq = _as_1d(laser_freq)
+        self.laser_duty_cycle = _as_1d(laser_duty_cycle)
+        self.laser_durations = _as_1d(laser_durations)
+
+        # struct-of-arrays storage of laser conditions, filled by init_lasers --
+        # per-trial draws index these rather than hashing keys out of dicts
+        self._cond_duration = np.empty(0, dtype=np.float32)
+        self._cond_duty = np.empty(0, dtype=np.float32)
+        self._cond_freq = np.empty(0, dtype=np.float32)
+        self._cond_script_id = tuple() # type: typing.Tuple[str, ...]
+        self._cond_trigger = tuple() # type: typing.Tuple[typing.Callable, ...]
+        self._n_conditions = 0
+        self._rng = random.Random()
         self.laser_script = None
 
         super(Nafc_Gap_Laser, self).__init__(**kwargs)
 
+        # hardware is instantiated by the superclass -- bind the objects we
+        # touch on every trial so the hot path skips the nested dict lookups
+        self._top_led = self.hardware['LEDS']['TOP']
+        self._laser = self.hardware['LASERS']['LR']
+
         # check for valid laser_mode
         if self.laser_mode not in ('L', 'R', 'BOTH'):
             err_text = f"Got invalid laser_mode, need one of 'L', 'R', 'BOTH', got {self.laser_mode}"
             self.logger.exception(err_text)
             raise ValueError(err_text)
 
+        # laser_mode is fixed for the session, so reduce the per-trial mode
+        # test to a set membership check against the target
+        self._laser_targets = frozenset('LR' if self.laser_mode == 'BOTH' else self.laser_mode)
+
+        # bind the arena LED trigger once rather than building a fresh lambda
+        # (and chasing two dict lookups) on every trial
+        self._led_on_trigger = (lambda _out=self._top_led: _out.series(id='on'))
+
         self.init_lasers()
 
         # -----------------------------------
@@ -159,15 +263,15 @@ class Nafc_Gap_Laser(Nafc_Gap):
         # use find_recursive to find all durations
         # FIXME: implement stimulus managers properly, including API to get attributes of stimuli
         if self.arena_led_mode == "ON":
-            self.hardware['LEDS']['TOP'].turn(True)
+            self._top_led.turn(True)
         elif self.arena_led_mode == "STIM":
-            stim_durations = list(find_key_recursive('duration', kwargs['stim']))
-            stim_durations_int = [int(i) for i in stim_durations]
-            max_duration = int(np.max(stim_durations_int))
-            self.hardware['LEDS']['TOP'].store_series('on', values=1, durations=max_duration )
+            # built-in max over the generator -- no list or ndarray round trip
+            # for what is typically a handful of durations
+            max_duration = max(int(d) for d in find_key_recursive('duration', kwargs['stim']))
+            self._top_led.store_series('on', values=1, durations=max_duration )
         elif self.arena_led_mode == "LASER":
             #assuming for now we have only a single laser duration, since I can't quite get the max duration to work for the str list
-            self.hardware['LEDS']['TOP'].store_series('on', values=1, durations=int(self.laser_durations) )
+            self._top_led.store_series('on', values=1, durations=int(self.laser_durations[0]) )
         else:
             raise ValueError(f'arena_led_mode must be one of ON or STIM or LASER, got {self.arena_led_mode}')
 
@@ -186,50 +290,57 @@ class Nafc_Gap_Laser(Nafc_Gap):
         # use them to create pigpio scripts using the Digital_Out.store_series() method
         # --------------------------------------------------
         self.logger.debug('Creating laser and LED series')
-        # create iterator
-        condition_iter = itertools.product(self.laser_durations, self.laser_freq, self.laser_duty_cycle)
-
-        conditions = []
-        for duration, freq, duty_cycle in condition_iter:
-            # get the durations of on and off for a single cycle
-            cycle_duration = (1/freq)*1000 # convert Hz to ms
-            duty_cycle_on = duty_cycle * cycle_duration
-            duty_cycle_off = cycle_duration - duty_cycle_on
-
-            # get number of repeats to make
-            n_cycles = int(np.floor(duration/cycle_duration))
-            durations = [duty_cycle_on, duty_cycle_off]*n_cycles
-            values = [1, 0]*n_cycles
-
-            # pad any incomplete cycles
-            dur_remaining = duration-(cycle_duration*n_cycles)
-            if dur_remaining < duty_cycle_on:
-                durations.append(dur_remaining)
-                values.append(1)
-            else:
-                durations.extend([duty_cycle_on, dur_remaining-duty_cycle_on])
-                values.extend([1, 0])
+        # build the condition grid in C rather than walking itertools.product
+        # in the interpreter -- 'ij' indexing keeps the same ordering
+        D, F, C = np.meshgrid(self.laser_durations, self.laser_freq,
+                              self.laser_duty_cycle, indexing='ij')
+
+        durs, duties, freqs, sids, trigs = [], [], [], [], []
+        for duration, freq, duty_cycle in zip(D.ravel(), F.ravel(), C.ravel()):
+            # build the on/off series (JITed when numba is available)
+            durations, values = _build_series(float(duration), float(freq), float(duty_cycle))
 
             # create ID from params
             script_id = f"{duration}_{freq}_{duty_cycle}"
 
 
             # store pulses as pigpio scripts
-            self.hardware['LASERS']['LR'].store_series(script_id, values=values, durations=durations)
+            # (as plain lists -- pigpio's script builder expects python sequences)
+            self._laser.store_series(script_id, values=values.tolist(), durations=durations.tolist())
 
-            conditions.append({
-                'freq':freq,
-                'duty_cycle': duty_cycle,
-                'duration': duration,
-                'script_id': script_id
-            })
+            durs.append(duration)
+            duties.append(duty_cycle)
+            freqs.append(freq)
+            sids.append(script_id)
+            # pre-bound callable so request/stim_end can play the series
+            # without allocating a closure per trial
+            trigs.append(lambda _out=self._laser, _id=script_id: _out.series(id=_id))
 
-        self.laser_conditions = tuple(conditions)
+        self._cond_duration = np.asarray(durs, dtype=np.float32)
+        self._cond_duty = np.asarray(duties, dtype=np.float32)
+        self._cond_freq = np.asarray(freqs, dtype=np.float32)
+        self._cond_script_id = tuple(sids)
+        self._cond_trigger = tuple(trigs)
+        self._n_conditions = len(self._cond_script_id)
 
-        self.logger.debug(f'Laser series created with {len(self.laser_conditions)} conditions')
+        self.logger.debug(f'Laser series created with {self._n_conditions} conditions')
 
 
+    @property
+    def laser_conditions(self) -> typing.Tuple[typing.Dict, ...]:
+        """
+        Laser conditions as a tuple of dicts (see ``__init__`` docstring for format).
 
+        Generated lazily from the internal per-condition arrays -- the trial
+        hot path indexes those directly instead of going through this view.
+        """
+        return tuple(
+            {'freq': float(f), 'duty_cycle': float(dc), 'duration': float(d),
+             'script_id': sid, 'trigger': trig}
+            for f, dc, d, sid, trig in zip(
+                self._cond_freq, self._cond_duty, self._cond_duration,
+                self._cond_script_id, self._cond_trigger)
+        )
 
     def request(self,*args,**kwargs):
         """
@@ -239,54 +350,56 @@ class Nafc_Gap_Laser(Nafc_Gap):
 
         If we present a laser on this trial, we randomly draw from :attr:`.laser_conditions` and call the appropriate script.
         """
-        # lock the triggers dict while we modify it
-        # (so handle_triggers will not call any of them while we are still preparing the stage)
-        self.trigger_lock.acquire()
-
-        # call the super method
-        data = super(Nafc_Gap_Laser, self).request(*args, **kwargs)
-        self.logger.debug(f'triggers: {self.triggers} ')
-
-        # handle laser logic
-        # if the laser_mode is fulfilled, roll for a laser
-        test_laser = False
-        if self.laser_mode == "L" and self.target == "L":
-            test_laser = True
-        elif self.laser_mode == "R" and self.target == "R":
-            test_laser = True
-        elif self.laser_mode == "BOTH":
-            test_laser = True
-
-        duration = 0
-        duty_cycle = 0
-        frequency = 0
-        do_laser = False
-        if test_laser:
-            # if we've rolled correctly for a laser...
-            if np.random.rand() <= self.laser_probability:
-                do_laser = True
-
-                # If we're doing laser, we don't do the stim, so we pop the first two triggers
-                #del self.triggers['C'][:2]
-                #mike 1.19.21
-
-                # pick a random duration
-                condition = np.random.choice(self.laser_conditions)
-                duration = condition['duration']
-                duty_cycle = condition['duty_cycle']
-                frequency = condition['freq']
-                #store laser condition
-                self.laser_script=condition
-                # insert the laser triggers before the rest of the triggers
-                # self.triggers['C'].insert(0, lambda: self.hardware['LASERS']['LR'].series(id=condition['script_id']))
-                # this would turn the laser on at gap onset, but instead we want it at gap termination so see stim_end
-        else:
-            self.laser_script = None
+        # lock the triggers dict while it is populated and while we modify it
+        # (so handle_triggers will not call any of them while we are still
+        # preparing the stage). The with-block guarantees release if anything
+        # below raises, where a bare acquire/release pair would deadlock every
+        # later trial. The laser draws stay inside since they depend on
+        # self.target (set by the super call) and on laser_script being set
+        # before the stim can end.
+        with self.trigger_lock:
+            # call the super method
+            data = super(Nafc_Gap_Laser, self).request(*args, **kwargs)
+            self.logger.debug('triggers: %s', self.triggers)
+
+            # handle laser logic
+            # if the laser_mode is fulfilled, roll for a laser
+            test_laser = self.target in self._laser_targets
+
+            duration = 0
+            duty_cycle = 0
+            frequency = 0
+            do_laser = False
+            if test_laser:
+                # if we've rolled correctly for a laser...
+                # (stdlib rng -- a single C call, vs np.random.rand allocating a
+                # 0-d array for one scalar)
+                if self._rng.random() <= self.laser_probability:
+                    do_laser = True
+
+                    # If we're doing laser, we don't do the stim, so we pop the first two triggers
+                    #del self.triggers['C'][:2]
+                    #mike 1.19.21
+
+                    # pick a random condition by index -- one integer draw reads all
+                    # four arrays, vs. np.random.choice boxing a tuple of dicts
+                    # into an object array on every trial
+                    i = self._rng.randrange(self._n_conditions)
+                    duration = float(self._cond_duration[i])
+                    duty_cycle = float(self._cond_duty[i])
+                    frequency = float(self._cond_freq[i])
+                    #store the trigger for the chosen laser condition
+                    self.laser_script = self._cond_trigger[i]
+                    # insert the laser triggers before the rest of the triggers
+                    # self.triggers['C'].insert(0, lambda: self.hardware['LASERS']['LR'].series(id=condition['script_id']))
+                    # this would turn the laser on at gap onset, but instead we want it at gap termination so see stim_end
+            else:
+                self.laser_script = None
 
 
-        # always turn the light on if arena mode is STIM
-        if self.arena_led_mode == "STIM":
-            self.triggers['C'].insert(0, lambda: self.hardware['LEDS']['TOP'].series(id='on'))
+            # always turn the light on if arena mode is STIM
+            if self._led_stim:
+                self.triggers['C'].insert(0, self._led_on_trigger)
 
 
         # store the data about the laser status
@@ -295,7 +408,6 @@ class Nafc_Gap_Laser(Nafc_Gap):
         data['laser_duty_cycle'] = duty_cycle
         data['laser_frequency'] = frequency
 
-        self.trigger_lock.release()
 
         # return the data created by the original task
         return data
@@ -307,15 +419,14 @@ class Nafc_Gap_Laser(Nafc_Gap):
         and where we turn on the arena LED if arena mode is set to LASER
         """
         if self.laser_script is not None:
-            condition=self.laser_script
-            self.hardware['LASERS']['LR'].series(id=condition['script_id'])
+            self.laser_script()
 
-        if self.arena_led_mode == "LASER":
+        if self._led_laser:
             with self.trigger_lock:
                 if 'C' in self.triggers.keys():
-                    self.triggers['C'].insert(0, lambda: self.hardware['LEDS']['TOP'].series(id='on'))
+                    self.triggers['C'].insert(0, self._led_on_trigger)
                 else:
-                    self.triggers['C'] = [lambda: self.hardware['LEDS']['TOP'].series(id='on')]
+                    self.triggers['C'] = [self._led_on_trigger]
 
     def set_leds(self, color_dict=None):
         """
@@ -338,8 +449,6 @@ class Nafc_Gap_Laser(Nafc_Gap):
         for k, v in self.hardware['LEDS'].items():
             if k == "TOP":
                 continue
-            if k in color_dict.keys():
-                v.set(color_dict[k])
-            else:
-                v.set(0)
+            # single dict lookup with a default covers both branches
+            v.set(color_dict.get(k, 0))
 
